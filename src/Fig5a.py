@@ -35,7 +35,7 @@ K = 30       # factors
 numM = 50    # number of groups
 Dm = 10      # dimension of each group
 D = Dm * np.ones(numM, dtype=int) #groups
-scalerD=Dm * numM
+GRMSE = np.zeros([len(R_array),numM])  # RMSE of each group, predicted from the others
 N_test = 10
 N_train = 40
 N_total = N_train + N_test
@@ -55,29 +55,15 @@ for r_index in range(len(R_array)):
         g.fit(X_train,D)
         
         leave = 0
-                    
-        Yminus=np.zeros([N_test,0]) # K x 0 (matrix will be expanded afterward)
-        
-        T=np.zeros([scalerD - Dm,scalerD - Dm]) # D-Dm x D-Dm
-      
-        Wminus=np.zeros([K,0]) # K x 0 (matrix will be expanded afterward)
-        Sigma=np.identity(K) # K x K
-        Wm=g.E_W(leave) # K x Dm               
-                    
+
         X_unseen = X_test[leave * Dm:(leave+1) * Dm, :].T
         # (N_test, Dm)
-        
-        count=0
-        for i in range(0,numM,1):
-                if i != leave:
-                    count=count+1
-                    Yminus=np.c_[Yminus, X_test.T[:,i*Dm:(i+1)*Dm]]  # N x D-Dm
-                    T[(count-1)*Dm:count*Dm,(count-1)*Dm:count*Dm]=g.E_tau(i)*np.identity(Dm) # diag({<tau_j>I_Dj}_j\neqm)                        
-                    Sigma=Sigma+g.E_tau(i)*g.E_WW(i) # I_k+\sum_{j\neqm}<tau_j><W^(j){W^(j)}^{T}>
-                    Wminus=np.c_[Wminus,g.E_W(i)] # Finally K x D-Dm 
-                    
-        Xmpre = Yminus @ T @ Wminus.T @ np.linalg.pinv(Sigma) @ Wm  
-        # (N_test x Dm) = (N_test x D-Dm)x(D-Dm x D-Dm)x(D-Dm x K)x(K x K)x(K x Dm)
+
+        # predict every group from all the others
+        X_pred, group_rmse = g.predict_loo(X_test)
+        Xmpre = X_pred[leave * Dm:(leave+1) * Dm, :].T
+        # (N_test x Dm)
+        GRMSE[r_index] += group_rmse
         
         maxi = X_unseen.max()
         mini = X_unseen.min()
@@ -90,6 +76,7 @@ for r_index in range(len(R_array)):
     RMSE[r_index] /= num_datasets
     NRMSE[r_index] /= num_datasets
     NSRMSE[r_index] /= num_datasets
+    GRMSE[r_index] /= num_datasets
         
 
 np.save('Fig5a-numdatasets{}-datasetindex{}-modelranks{}-{}-{}-yaxis'.format(
@@ -98,6 +85,8 @@ np.save('Fig5a-numdatasets{}-datasetindex{}-modelranks{}-{}-{}-yaxis-N'.format(
     num_datasets, datasetindex, rstart, rend, rstep), NRMSE)
 np.save('Fig5a-numdatasets{}-datasetindex{}-modelranks{}-{}-{}-yaxis-NS'.format(
     num_datasets, datasetindex, rstart, rend, rstep), NSRMSE)
+np.save('Fig5a-numdatasets{}-datasetindex{}-modelranks{}-{}-{}-yaxis-groups'.format(
+    num_datasets, datasetindex, rstart, rend, rstep), GRMSE)
 np.save('Fig5a-numdatasets{}-datasetindex{}-modelranks{}-{}-{}-xaxis'.format(
     num_datasets, datasetindex, rstart, rend, rstep), np.array(R_array))
 
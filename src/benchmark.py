@@ -0,0 +1,131 @@
+"""Scaling benchmarks of gfa
+
+Times GFA.fit, GFA_rep, the update steps and the alpha objective on data
+from generate_data.generation for every combination of the given sample
+sizes N, numbers of groups M, group sizes Dm, factors K and ranks R, and
+records the wall time and the peak memory (of the numpy and python
+allocations, through tracemalloc) of each.
+
+usage: python benchmark.py --N 200 1000 --M 10 50 --K 10 --R 2 4 \\
+                           --out bench.json --csv bench.csv
+"""
+import argparse
+import csv
+import itertools
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+import gfa
+from generate_data import generation
+
+CASES = ["fit", "GFA_rep", "update_W", "update_Z", "update_alpha",
+         "update_tau", "bound", "bound_uv", "grad_uv"]
+
+def measure(f, repeat):
+    """Time f over 'repeat' calls, then measure the peak memory of one more
+
+    Output:
+    the minimum and median time in seconds and the peak memory in bytes
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        f()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), float(np.median(times)), peak
+
+def make_case(case, X, D, kwargs, iters, restarts):
+    """Get a function running benchmark 'case' on data X with groups D"""
+    if case == "fit":
+        def run():
+            gfa.GFA(**kwargs).fit(X, D)
+        return run
+    if case == "GFA_rep":
+        def run():
+            gfa.GFA_rep(X, D, n=restarts, **kwargs)
+        return run
+
+    # the single steps are timed on a model that has been iterated a bit
+    g = gfa.GFA(**kwargs)
+    g.start(X, D)
+    g.iterate(iters)
+    f = getattr(g, case)
+    if case in ("bound_uv", "grad_uv"):
+        x = gfa.flatten_matrices(g.U, g.V, g.mu_u, g.mu_v)
+        return lambda: f(x)
+    def run():
+        # time the step together with the moments it needs, instead of
+        # reusing those cached by the previous call
+        g._invalidate(*g._version)
+        f()
+    return run
+
+def run_benchmarks(Ns, Ms, Dms, Ks, Rs, cases=CASES, iters=20, repeat=3,
+                   restarts=2, seed=0, **gfa_kwargs):
+    """Run the benchmarks over the grid of problem sizes
+
+    Output:
+    list of dicts, one per case and problem size, with the parameters, the
+    minimum and median time in seconds and the peak memory in bytes
+    """
+    results = []
+    for N, M, Dm, K, R in itertools.product(Ns, Ms, Dms, Ks, Rs):
+        if R > min(M, K):
+            continue
+        np.random.seed(seed)
+        D = np.full(M, Dm, dtype=int)
+        X = generation(N, K, D, R, constrain_W=10, fixed_tau=1.0)[0]
+        # a fixed amount of work per fit, independently of convergence
+        kwargs = dict(factors=K, rank=R, max_iter=iters, tol=0.0,
+                      random_state=seed, **gfa_kwargs)
+        for case in cases:
+            t_min, t_median, peak = measure(
+                make_case(case, X, D, kwargs, iters, restarts), repeat)
+            results.append({"case": case, "N": N, "M": M, "Dm": Dm, "K": K,
+                            "R": R, "time_min": t_min, "time_median": t_median,
+                            "peak_bytes": peak})
+            print("{case:>12} N={N} M={M} Dm={Dm} K={K} R={R}: "
+                  "{time_min:.4g} s, {peak_bytes} B".format(**results[-1]))
+    return results
+
+def save_csv(results, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of gfa")
+    parser.add_argument("--N", type=int, nargs="+", default=[200, 1000])
+    parser.add_argument("--M", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--Dm", type=int, nargs="+", default=[10])
+    parser.add_argument("--K", type=int, nargs="+", default=[10])
+    parser.add_argument("--R", type=int, nargs="+", default=[2, 6])
+    parser.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--iters", type=int, default=20,
+                        help="iterations of each fit (and before timing a step)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--restarts", type=int, default=2,
+                        help="restarts of the GFA_rep case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--csv", default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.N, args.M, args.Dm, args.K, args.R,
+                             cases=args.cases, iters=args.iters,
+                             repeat=args.repeat, restarts=args.restarts,
+                             seed=args.seed)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=1)
+    if args.csv is not None:
+        save_csv(results, args.csv)
@@ -1,5 +1,15 @@
+import os
+import copy
+import contextlib
+import mmap
+import csv
+import json
+import time
+import concurrent.futures
+import multiprocessing
 import numpy as np
 import scipy.special
+import scipy.linalg
 import scipy.optimize as opt
 
 def split_and_reshape(flattened, *args):
@@ -17,31 +27,443 @@ def trprod(A, B):
     Hadamard product"""
     return (A.T * B).sum()
 
-def GFA_rep(X, D, n=5, debug_iter=False, **kwargs):
-    """Fits the GFA model n times and returns the best fit (maximum lower bound)"""
-
-    models = []
+def as_float64(A):
+    """Convert A to float64, without copying if it already is"""
+    return A.astype(np.float64, copy=False)
+
+def chol_inv(A):
+    """Invert (a stack of) symmetric positive definite matrices A through
+    their Cholesky factors
+
+    Output:
+    the inverses and the log-determinants of the inverses
+    """
+    K = A.shape[-1]
+    if K < 32:
+        # small matrices: the batched numpy routines avoid a python loop,
+        # which would cost more than the factorizations themselves
+        L = np.linalg.cholesky(A)
+        L_inv = np.linalg.solve(L, np.broadcast_to(np.eye(K), A.shape))
+        logdet = -2 * np.sum(np.log(np.diagonal(L, axis1=-2, axis2=-1)), axis=-1)
+        return np.swapaxes(L_inv, -1, -2) @ L_inv, logdet
+
+    stack = np.reshape(A, (-1, K, K))
+    inv = np.empty(stack.shape)
+    logdet = np.empty(len(stack))
+    lower = np.tri(K, k=-1, dtype=bool)
+    for i, A_i in enumerate(stack):
+        L, info = scipy.linalg.lapack.dpotrf(A_i, lower=1, clean=0)
+        if info != 0:
+            raise np.linalg.LinAlgError("Matrix is not positive definite")
+        logdet[i] = -2 * np.sum(np.log(np.diagonal(L)))
+        # potri fills in the lower triangle of the inverse only
+        inv_i, info = scipy.linalg.lapack.dpotri(L, lower=1)
+        if info != 0:
+            raise np.linalg.LinAlgError("Matrix is singular")
+        inv[i] = np.where(lower, inv_i, inv_i.T)
+    return inv.reshape(A.shape), logdet.reshape(A.shape[:-2])[()]
+
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS", "BLIS_NUM_THREADS")
+
+def _limit_blas_threads(n):
+    """Process pool initializer capping the BLAS thread count of a worker"""
+    try:
+        import threadpoolctl
+    except ImportError:
+        # the environment variables set by the parent process apply instead
+        return
+    threadpoolctl.threadpool_limits(n)
+
+@contextlib.contextmanager
+def blas_limited_pool(n_jobs, blas_threads=1):
+    """Context manager of a pool of n_jobs freshly spawned worker processes
+    (a concurrent.futures.ProcessPoolExecutor), each using at most
+    blas_threads BLAS threads"""
+    # the environment variables only take effect in freshly spawned workers
+    old_env = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(blas_threads) for var in BLAS_THREAD_VARS})
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_limit_blas_threads,
+                initargs=(blas_threads,),
+                mp_context=multiprocessing.get_context("spawn")) as pool:
+            yield pool
+    finally:
+        for var, value in old_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def _memmap_args(X):
+    """Get the arguments of np.memmap reopening memory-mapped X read-only in
+    another process, or None if X is not a memmap of a whole file region
+    (e.g. a slice of one)"""
+    if (not isinstance(X, np.memmap) or not isinstance(X.base, mmap.mmap)
+            or X.filename is None):
+        return None
+    order = "F" if X.flags.f_contiguous and not X.flags.c_contiguous else "C"
+    return dict(filename=X.filename, dtype=X.dtype, mode="r", offset=X.offset,
+                shape=X.shape, order=order)
+
+def _fit_restart(X, D, seed, kwargs):
+    """Fit a single restart of GFA_rep in a worker process; X may also be
+    given by the arguments of np.memmap (see _memmap_args)"""
+    if isinstance(X, dict):
+        X = np.memmap(**X)
+    g = GFA(random_state=seed, **kwargs)
+    g.fit(X, D)
+    # a restart resumed from a finished checkpoint has no cached bound yet
+    bound = g.bound()
+    # drop the data, the parent process already has it
+    g.X = g._X = None
+    if g.z_path is not None:
+        # the parent reopens the file instead of receiving a copy of E[Z]
+        g.m_Z.flush()
+        g.m_Z = None
+    return bound, g
+
+def _restart_path(path, i):
+    """Suffix the file name 'path' with restart index i, e.g. ck.npz -> ck-1.npz"""
+    root, ext = os.path.splitext(path)
+    return "{}-{}{}".format(root, i, ext)
+
+def _restart_kwargs(kwargs, i):
+    """Get the GFA options of restart i, which checkpoints and writes E[Z]
+    to files of its own"""
+    kwargs = dict(kwargs)
+    for name in ("checkpoint_path", "z_path"):
+        if kwargs.get(name) is not None:
+            kwargs[name] = _restart_path(kwargs[name], i)
+    return kwargs
+
+def _keep_restart_z(model, z_path, n):
+    """Move the memory-mapped E[Z] of 'model', the chosen one of n restarts,
+    to z_path and remove those of the other restarts"""
+    if model.m_Z is not None:
+        model.m_Z.flush()
     for i in range(n):
-        if debug_iter:
-            print("Fitting model {}...".format(i))
-        g = GFA(**kwargs)
-        g.fit(X,D)
-        if debug_iter:
-            print("Bound:", g.bound())
+        path = _restart_path(z_path, i)
+        if path != model.z_path and os.path.exists(path):
+            os.remove(path)
+    os.replace(model.z_path, z_path)
+    # factors dropped while fitting only leave the first rows of the file in use
+    model.m_Z = np.load(z_path, mmap_mode="r+")[:model.factors]
+    model.z_path = z_path
+
+def GFA_race(X, D, seeds, race_iter=10, eta=2, debug_iter=False, **kwargs):
+    """Fit the restarts in 'seeds' by successive halving: all restarts are run
+    for race_iter iterations, after which only the best 1/eta of them (by
+    lower bound) are kept and given eta times as many iterations, until a
+    single restart remains, which is then run to convergence"""
+    models = []
+    for i, seed in enumerate(seeds):
+        g = GFA(random_state=seed, **_restart_kwargs(kwargs, i))
+        g.start(X, D)
         models.append(g)
-
-    max_model = max(models, key=lambda g:g.bound())
-    index, model = max(enumerate(models), key=lambda x:x[1].bound())
+    max_iter = models[0].max_iter
+
+    alive = list(range(len(models)))
+    budget = race_iter
+    while len(alive) > 1:
+        for i in alive:
+            models[i].iterate(min(budget, max_iter - models[i].n_iter))
+        alive.sort(key=lambda i:models[i].cost[-1], reverse=True)
+        if debug_iter:
+            print("Racing: bounds", [models[i].cost[-1] for i in alive])
+        alive = alive[:max(1, -(-len(alive) // eta))]
+        budget *= eta
+
+    index = alive[0]
+    model = models[index]
+    if not model.iterate(max_iter - model.n_iter):
+        print("Reach the maximum number of iterations")
+    if kwargs.get("z_path") is not None:
+        _keep_restart_z(model, kwargs["z_path"], len(models))
     if debug_iter:
         print("Returning model {} at bound {}".format(index, model.bound()))
     return model
 
+def GFA_rep(X, D, n=5, debug_iter=False, n_jobs=1, seed=None, blas_threads=1,
+            race=False, race_iter=10, race_eta=2, **kwargs):
+    """Fits the GFA model n times and returns the best fit (maximum lower bound)
+
+    Input:
+    n_jobs: number of worker processes to fit the restarts in
+    seed: seed for the restarts (also accepted as random_state); each
+          restart gets its own independent np.random.Generator spawned from
+          it. If None and n_jobs == 1, the global numpy random state is used
+    blas_threads: maximum number of BLAS threads in each worker process
+    race: instead of fitting every restart to convergence, drop the restarts
+          that fall behind early on (see GFA_race)
+    race_iter, race_eta: iterations of the first racing round and the
+          reduction factor of each round
+
+    With a checkpoint_path in kwargs, restart i checkpoints to (and resumes
+    from) that path suffixed with -i, e.g. ck-0.npz. Likewise with a z_path,
+    restart i writes E[Z] to its own file, of which only that of the returned
+    model is kept, moved to z_path
+    """
+    # a random_state meant for GFA seeds the restarts, which must not share it
+    random_state = kwargs.pop("random_state", None)
+    if seed is None:
+        seed = random_state
+    if seed is None and n_jobs == 1:
+        seeds = [None] * n
+    elif isinstance(seed, (np.random.Generator, np.random.SeedSequence)):
+        seeds = seed.spawn(n)
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(n)
+
+    if race:
+        if n_jobs != 1:
+            raise ValueError("Racing restarts is only supported with n_jobs=1")
+        return GFA_race(X, D, seeds, race_iter=race_iter, eta=race_eta,
+                        debug_iter=debug_iter, **kwargs)
+
+    if n_jobs == 1:
+        models = []
+        for i in range(n):
+            if debug_iter:
+                print("Fitting model {}...".format(i))
+            g = GFA(random_state=seeds[i], **_restart_kwargs(kwargs, i))
+            g.fit(X,D)
+            if debug_iter:
+                print("Bound:", g.bound())
+            models.append(g)
+
+        index, model = max(enumerate(models), key=lambda x:x[1].bound())
+        if kwargs.get("z_path") is not None:
+            _keep_restart_z(model, kwargs["z_path"], n)
+        if debug_iter:
+            print("Returning model {} at bound {}".format(index, model.bound()))
+        return model
+
+    # a memmap would be pickled into every worker as an in-memory copy, so
+    # the workers reopen its file instead (as they load .npy paths)
+    X_arg = _memmap_args(X)
+    if X_arg is None:
+        X_arg = X
+
+    with blas_limited_pool(n_jobs, blas_threads) as pool:
+        futures = {pool.submit(_fit_restart, X_arg, D, seeds[i], _restart_kwargs(kwargs, i)): i
+                   for i in range(n)}
+        best = None
+        # keep only the best model around as the restarts finish
+        for future in concurrent.futures.as_completed(futures):
+            bound, g = future.result()
+            if debug_iter:
+                print("Bound of model {}: {}".format(futures[future], bound))
+            if best is None or bound > best[1]:
+                best = (futures[future], bound, g)
+            del futures[future]
+
+    index, bound, model = best
+    if kwargs.get("z_path") is not None:
+        _keep_restart_z(model, kwargs["z_path"], n)
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode="r")
+    if not isinstance(X, np.memmap):
+        X = np.asarray(X, dtype=model.dtype)
+    if model.missing:
+        X = np.where(np.isnan(X), 0, X)
+    model.X = np.split(X, np.add.accumulate(model.D[:-1]))
+    model._X = X
+    if debug_iter:
+        print("Returning model {} at bound {}".format(index, bound))
+    return model
+
+class ConvergencePolicy:
+    """Decides when GFA.iterate stops
+
+    Input:
+    tol: converged when the bound changes less than tol per update
+    rtol: converged when the bound changes less than rtol |bound| per update
+    patience: number of consecutive bound evaluations (or parameter checks)
+              that must meet the tolerances before stopping
+    param_tol: converged when the parameters of get_state change less than
+               param_tol relative to their norm in an update; None disables
+               this check, which copies E[Z] at every update
+    max_time: stop after max_time seconds of wall-clock time in iterate
+    max_iter: stop after max_iter updates in total (besides the max_iter
+              given to iterate)
+    bound_every: only evaluate the bound every bound_every updates, and
+                 when stopping
+    """
+
+    def __init__(self, tol=1e-2, rtol=0.0, patience=1, param_tol=None,
+                 max_time=None, max_iter=None, bound_every=1):
+        self.tol = tol
+        self.rtol = rtol
+        self.patience = patience
+        self.param_tol = param_tol
+        self.max_time = max_time
+        self.max_iter = max_iter
+        self.bound_every = bound_every
+
+    def reset(self, model):
+        """Start checking a call to model.iterate"""
+        self.start_time = time.monotonic()
+        self.last_bound = model.cost[-1]
+        self.last_iter = model.n_iter
+        self.last_state = None
+        self.hits = self.param_hits = 0
+
+    def want_bound(self, n_iter):
+        """Whether to evaluate the bound after update n_iter"""
+        return n_iter % self.bound_every == 0
+
+    def out_of_budget(self, n_iter):
+        """Whether the time or the iteration budget is used up"""
+        if self.max_iter is not None and n_iter >= self.max_iter:
+            return "max_iter"
+        if self.max_time is not None and time.monotonic() - self.start_time >= self.max_time:
+            return "max_time"
+        return None
+
+    def converged(self, model, bound):
+        """Check for convergence after an update, given the bound if it was
+        evaluated (None otherwise)"""
+        if bound is not None:
+            change = np.abs(bound - self.last_bound) / max(model.n_iter - self.last_iter, 1)
+            if change < self.tol or change < self.rtol * np.abs(bound):
+                self.hits += 1
+            else:
+                self.hits = 0
+            self.last_bound = bound
+            self.last_iter = model.n_iter
+            if self.hits >= self.patience:
+                return True
+
+        if self.param_tol is not None:
+            x = model.get_state()
+            if self.last_state is not None and len(x) == len(self.last_state):
+                if (np.linalg.norm(x - self.last_state)
+                        < self.param_tol * np.linalg.norm(self.last_state)):
+                    self.param_hits += 1
+                else:
+                    self.param_hits = 0
+            self.last_state = x
+            if self.param_hits >= self.patience:
+                return True
+        return False
+
+def GFA_rank_path(X, D, ranks, pad_scale=1e-2, debug_iter=False, **kwargs):
+    """Fit GFA for each model rank in 'ranks', from the smallest to the
+    largest, starting each fit from the solution of the previous rank
+    (see GFA.warm_start) instead of from a random initialization
+
+    Output:
+    the lower bounds and the fitted models, one per rank in increasing order
+    """
+    ranks = sorted(ranks)
+    g = GFA(rank=ranks[0], **kwargs)
+    g.fit(X, D)
+    models = [g]
+    for rank in ranks[1:]:
+        g = g.warm_start(rank, pad_scale)
+        if not g.iterate(g.max_iter):
+            print("Reach the maximum number of iterations")
+        if debug_iter:
+            print("Rank {}: bound {} after {} iterations".format(
+                rank, g.cost[-1], g.n_iter))
+        models.append(g)
+    return [g.cost[-1] for g in models], models
+
+# the state saved by GFA.save_checkpoint besides E[W] and the random state
+CHECKPOINT_FIELDS = ["m_Z", "sigma_Z", "logdet_sigma_Z", "sigma_W", "logdet_sigma_W",
+                     "U", "V", "mu_u", "mu_v", "alpha", "a_tau", "b_tau",
+                     "first_update", "rotate", "N_prev", "prev_ZZ", "prev_ZX",
+                     "prev_ent_Z", "XX", "n_obs", "cost", "n_iter", "converged"]
+
+# the options of a fit that a checkpoint must have been saved with, see
+# GFA.fingerprint
+FINGERPRINT_OPTIONS = ["lamb", "rank", "factors", "a_tau_prior", "b_tau_prior",
+                       "init_tau", "optimize_method", "factr", "suff_stats",
+                       "drop_factors", "drop_tol", "rotate", "alpha_update",
+                       "random_state", "dtype"]
+
+class Trace:
+    """Record of the wall time of the update steps of a fit, per iteration
+
+    Each record (a dict in 'records') holds the iteration number 'iter',
+    the wall time since the previous record 'time', the lower bound 'bound'
+    (None where it was not evaluated) and its change 'delta', and for each
+    step name (update_W, update_Z, update_rotation, update_alpha,
+    update_tau, bound) the total time '<name>_time' and number of calls
+    '<name>_calls' within the iteration. Steps returning a scipy
+    OptimizeResult also add its nfev, njev and nit, e.g. 'update_alpha_nfev'.
+    When a fit stops at an iteration whose bound was skipped, the final
+    bound is evaluated in a record of its own with the same 'iter'.
+
+    Input:
+    callback: function called with each record as it is completed
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+        self._current = {}
+        self._last_time = time.perf_counter()
+        self._last_bound = None
+
+    def add(self, name, seconds, result=None):
+        """Add a call of step 'name' taking 'seconds' to the current record"""
+        rec = self._current
+        rec[name + "_time"] = rec.get(name + "_time", 0.0) + seconds
+        rec[name + "_calls"] = rec.get(name + "_calls", 0) + 1
+        if isinstance(result, dict):
+            for field in ("nfev", "njev", "nit"):
+                if field in result:
+                    key = "{}_{}".format(name, field)
+                    rec[key] = rec.get(key, 0) + int(result[field])
+
+    def end_iteration(self, n_iter, bound):
+        """Complete the current record at iteration n_iter"""
+        now = time.perf_counter()
+        rec = self._current
+        rec["iter"] = n_iter
+        rec["time"] = now - self._last_time
+        rec["bound"] = None if bound is None else float(bound)
+        rec["delta"] = (None if bound is None or self._last_bound is None
+                        else float(bound - self._last_bound))
+        self.records.append(rec)
+        self._current = {}
+        self._last_time = now
+        if bound is not None:
+            self._last_bound = bound
+        if self.callback is not None:
+            self.callback(rec)
+
+    def fields(self):
+        first = ["iter", "time", "bound", "delta"]
+        rest = set().union(*self.records) - set(first)
+        return first + sorted(rest)
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.records, f)
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, self.fields())
+            writer.writeheader()
+            writer.writerows(self.records)
+
 class GFA:
 
     def __init__(self, rank=4, factors=7, max_iter=1000, lamb=0.1,
                  a_tau_prior=1e-14, b_tau_prior=1e-14,
                  tol=1e-2, init_tau=1e3, optimize_method="L-BFGS-B",
-                 opt_iter=10**5, factr=1e10, debug=False):
+                 opt_iter=10**5, factr=1e10, suff_stats=True,
+                 drop_factors=False, drop_tol=1e-7, low_mem=False,
+                 chunk_size=4096, z_path=None, rotate=False, rotate_method="BFGS",
+                 rotate_iter=100, alpha_update="auto", random_state=None,
+                 dtype=np.float64, accelerate=False, convergence=None,
+                 trace=False, callback=None, checkpoint_path=None,
+                 checkpoint_every=None, checkpoint_time=None, resume=True,
+                 debug=False):
         self.lamb = lamb
         self.rank = rank
         self.factors = factors
@@ -54,55 +476,624 @@ class GFA:
         self.factr = factr
         self.tol = tol
         self.max_iter = max_iter
+        # ConvergencePolicy deciding when to stop iterating; by default the
+        # fit stops when the bound changes less than tol
+        self.convergence = convergence
+        # low_mem: never allocate anything of the size of (a group of) X.
+        # Besides X and the parameters themselves (m_Z: K x N, m_W: K x d,
+        # sigma_W: M x K x K) a fit then needs O(K (d + chunk_size) + M K^2)
+        # memory, as opposed to O(K (d + N) + max(Dm) N) otherwise
+        self.low_mem = low_mem
+        self.chunk_size = chunk_size
+        # write E[Z] to a memory-mapped .npy file at this path (implies low_mem)
+        self.z_path = z_path
+        # the residuals of the direct E_X_WZ computation are of size Dm x N
+        self.suff_stats = suff_stats or low_mem
+        # remove factors whose mean E[z_k]^2 falls below drop_tol while
+        # fitting, like opts$dropK in the reference implementation
+        self.drop_factors = drop_factors
+        self.drop_tol = drop_tol
+        # optimize a linear rotation of Z and W after each update of Z
+        # (full rank only), like opts$rotate in the reference implementation
+        self.rotate = rotate
+        self.rotate_method = rotate_method
+        self.rotate_iter = rotate_iter
+        # "optimize": fit U, V, mu_u and mu_v numerically
+        # "closed_form": set alpha(m,k) = Dm / E[W(m) W(m).T](k,k), which is
+        #                the optimum when the rank is no constraint (ignoring
+        #                the ridge penalty lamb)
+        # "auto": closed form when the rank is full, numerical otherwise
+        self.alpha_update = alpha_update
+        # seed or np.random.Generator; None draws from the global numpy state
+        self.random_state = random_state
+        # dtype of X, Z and W and of the products between them, e.g.
+        # np.float32 to halve their memory; the K x K covariances and the
+        # lower bound are always computed in float64
+        self.dtype = np.dtype(dtype)
+        # extrapolate the parameters along every two updates (SQUAREM),
+        # falling back to the plain updates when the bound decreases
+        self.accelerate = accelerate
+        # time the update steps of each iteration in a Trace (fit_trace),
+        # calling callback with each record; without it no timing is done
+        self.trace = trace or callback is not None
+        self.callback = callback
+        # save the state of the fit to the .npz file checkpoint_path every
+        # checkpoint_every iterations and/or checkpoint_time seconds, and
+        # when iterate stops; with resume, fit continues from the checkpoint
+        # if the file exists, which must be of a fit of the same data with
+        # the same options (load_checkpoint raises otherwise)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_time = checkpoint_time
+        self.resume = resume
         self.debug = debug
 
-    def fit(self, X, D):
+    def fit(self, X, D, mask=None):
         """Infer latent variables from data and group divisions
 
         Input:
         X: data array of size d x N, where d is the amount of variables and
-           N is the sample size
+           N is the sample size. May also be an np.memmap or the path of a
+           .npy file, which is then memory-mapped; the data is then only
+           accessed in chunks of chunk_size samples (see low_mem)
         D: 1D array specifying the group divisions, i.e. D = [2,3] would mean there
            are two groups, corresponding to variables 1-2 and 3-5 respectively
+        mask: boolean array of size d x N which is False for the missing
+              entries of X; by default the NaN entries of X are missing
 
         Output:
         After running, the inferred parameters will be available as fields
         """
 
-        self.init(X,D)
+        if (self.resume and self.checkpoint_path is not None
+                and os.path.exists(self.checkpoint_path)):
+            self.load_checkpoint(self.checkpoint_path, X, D, mask)
+            if self.debug:
+                print("Resuming from iteration {}".format(self.n_iter))
+        else:
+            self.start(X, D, mask)
+        if not self.iterate(self.max_iter - self.n_iter):
+            if self.stop_reason == "max_time":
+                print("Reach the time limit")
+            else:
+                print("Reach the maximum number of iterations")
+
+        if self.debug:
+            print("Took {} iterations".format(self.n_iter))
+            print("Maximal lower bound: {}".format(self.cost[-1]))
+
+    def start(self, X, D, mask=None):
+        """Initialize the fit and make the first update, without iterating"""
+        self.init(X, D, mask)
         self.update_params()
 
-        self.cost = [self.bound()]
-        for i in range(self.max_iter):
-            self.update_params()
-            self.cost.append(self.bound())
+        self.cost = [self.step("bound", self.bound)]
+        self.n_iter = 0
+        self.converged = False
+        self.stop_reason = None
+        if self.fit_trace is not None:
+            self.fit_trace.end_iteration(0, self.cost[0])
+        self._checkpoint_iter = 0
+        self._checkpoint_clock = time.monotonic()
+
+    def iterate(self, max_iter):
+        """Run up to max_iter further iterations of the fit started by
+        start(), stopping early if the convergence policy says so
+
+        Output:
+        whether the fit has converged; the reason for stopping ("converged",
+        "max_iter" or "max_time") is stored in stop_reason
+        """
+        policy = self.convergence or ConvergencePolicy(tol=self.tol)
+        policy.reset(self)
+        end = self.n_iter + max_iter
+        while not self.converged:
+            i = self.n_iter
+            if i >= end:
+                self.stop_reason = "max_iter"
+                break
+            self.stop_reason = policy.out_of_budget(i)
+            if self.stop_reason is not None:
+                break
 
-            if np.abs(self.cost[i] - self.cost[i-1]) < self.tol:
+            # a SQUAREM step makes up to 4 updates (when it falls back)
+            if self.accelerate and end - i >= 4:
+                n_updates, bound = self.squarem_step()
+            else:
+                self.update_params()
+                n_updates = 1
+                bound = self.step("bound", self.bound) if policy.want_bound(i + 1) else None
+            self.n_iter += n_updates
+            if bound is not None:
+                self.cost.append(bound)
+            if self.fit_trace is not None:
+                self.fit_trace.end_iteration(self.n_iter, bound)
+
+            if policy.converged(self, bound):
                 if self.debug:
                     print("Successful fit")
-                break
+                self.converged = True
+                self.stop_reason = "converged"
+
+            if bound is not None and (i == 0 or i // 10 != self.n_iter // 10) and self.debug:
+                print("Lower bound at iteration {}: {}".format(self.n_iter, self.cost[-1]))
+
+            if self.checkpoint_due():
+                self.save_checkpoint(self.checkpoint_path)
+
+        if policy.last_iter != self.n_iter:
+            # the bound of the final parameters was skipped
+            bound = self.step("bound", self.bound)
+            self.cost.append(bound)
+            if self.fit_trace is not None:
+                self.fit_trace.end_iteration(self.n_iter, bound)
+        if self.checkpoint_path is not None and self._checkpoint_iter != self.n_iter:
+            self.save_checkpoint(self.checkpoint_path)
+        return self.converged
+
+    def checkpoint_due(self):
+        """Whether a checkpoint should be saved after the current iteration"""
+        if self.checkpoint_path is None:
+            return False
+        if (self.checkpoint_every is not None
+                and self.n_iter - self._checkpoint_iter >= self.checkpoint_every):
+            return True
+        return (self.checkpoint_time is not None
+                and time.monotonic() - self._checkpoint_clock >= self.checkpoint_time)
+
+    def save_checkpoint(self, path):
+        """Save the state of the fit (the variational parameters, U, V, mu_u,
+        mu_v, the statistics of the samples folded in by partial_fit, the
+        lower bounds so far and the random state) to a compressed .npz file
+        at 'path', replacing it atomically"""
+        state = {name: getattr(self, name) for name in CHECKPOINT_FIELDS}
+        state["W"] = self.E_W_all()
+        if self.missing:
+            state["sigma_Z_p"] = self.sigma_Z_p
+            state["sigma_W_rows"] = self.sigma_W_rows
+        if self.hess_inv is not None:
+            state["hess_inv"] = self.hess_inv
+        if self.rng is np.random:
+            kind, keys, pos, has_gauss, gauss = np.random.get_state()
+            rng_state = {"legacy": [kind, keys.tolist(), pos, has_gauss, gauss]}
+        else:
+            rng_state = {"generator": self.rng.bit_generator.state}
+        state["rng_state"] = json.dumps(rng_state)
+        state["fingerprint"] = self.fingerprint()
+        state["X_sums"] = self._X_sums
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **state)
+        os.replace(tmp_path, path)
+        self._checkpoint_iter = self.n_iter
+        self._checkpoint_clock = time.monotonic()
+
+    def load_checkpoint(self, path, X, D, mask=None):
+        """Restore a fit of X saved by save_checkpoint, after which iterate
+        continues it exactly; the options must be those of the saved fit"""
+        self.init(X, D, mask)
+        with np.load(path) as f:
+            state = dict(f)
+        if state["W"].shape[1] != self.variables or state["m_Z"].shape[1] != self.N:
+            raise ValueError("checkpoint {} is of data of another size".format(path))
+        # checkpoints of other data of the same size are told apart by the
+        # sums of X (up to the rounding of summing them in other chunks)
+        fingerprint = state.pop("fingerprint", None)
+        X_sums = state.pop("X_sums", None)
+        if (fingerprint is None or str(fingerprint) != self.fingerprint()
+                or not np.allclose(X_sums, self._X_sums, rtol=1e-10, atol=0)):
+            raise ValueError("checkpoint {} is of another fit (other data or "
+                             "options)".format(path))
+
+        m_Z = state.pop("m_Z")
+        self.factors = m_Z.shape[0]
+        if self.z_path is None:
+            self.m_Z = m_Z.astype(self.dtype)
+        else:
+            self.m_Z = self.m_Z[:self.factors]
+            for chunk in self.chunks():
+                self.m_Z[:, chunk] = m_Z[:, chunk]
+        W = state.pop("W")
+        rng_state = json.loads(str(state.pop("rng_state")))
+        for name, value in state.items():
+            setattr(self, name, value.item() if value.ndim == 0 else value)
+        self.cost = list(self.cost)
+        self.stop_reason = "converged" if self.converged else None
+        self.set_m_W(self.split_buckets(W))
+
+        if "legacy" in rng_state:
+            kind, keys, pos, has_gauss, gauss = rng_state["legacy"]
+            np.random.set_state((kind, np.array(keys, dtype=np.uint32), pos,
+                                 has_gauss, gauss))
+        else:
+            self.rng.bit_generator.state = rng_state["generator"]
+        self._checkpoint_iter = self.n_iter
+        self._checkpoint_clock = time.monotonic()
+        self._invalidate(*self._version)
+
+    def fingerprint(self):
+        """Describe the fit for matching checkpoints to it: the options in
+        FINGERPRINT_OPTIONS as they were when the fit was initialized, the
+        group sizes and the number of samples"""
+        return json.dumps(dict(self._options, D=self.D.tolist(), N=self.N),
+                          sort_keys=True, default=repr)
+
+    def get_state(self):
+        """Flatten the parameters that update_params starts from: E[Z],
+        log alpha, log b_tau, and U, V, mu_u and mu_v (the starting point of
+        the update of alpha)"""
+        return np.concatenate([self.m_Z.ravel(), np.log(self.alpha).ravel(),
+                               np.log(self.b_tau),
+                               flatten_matrices(self.U, self.V, self.mu_u, self.mu_v)])
+
+    def set_state(self, x):
+        """Restore the parameters flattened by get_state"""
+        m_Z, ln_alpha, ln_b_tau, uv = split_and_reshape(
+            x, self.m_Z.shape, self.alpha.shape, self.b_tau.shape,
+            ((self.groups + self.factors) * (self.rank + 1),))
+        self.m_Z = m_Z.astype(self.dtype)
+        self.alpha = np.exp(ln_alpha)
+        self.b_tau = np.exp(ln_b_tau)
+        self.U, self.V, self.mu_u, self.mu_v = self.recover_matrices(uv)
+        self._invalidate("Z", "alpha", "tau")
+
+    def squarem_step(self):
+        """Make two updates and extrapolate the parameters along them by
+        the SQUAREM scheme (S3 step length, Varadhan & Roland 2008), followed
+        by a stabilizing update. If the bound is lower than before, the two
+        plain updates are continued by another one instead.
 
-            if (i == 0 or (i+1) % 10 == 0) and self.debug:
-                print("Lower bound at iteration {}: {}".format(i+1, self.cost[i]))
-        else: # nobreak
-            print("Reach the maximum number of iterations")
+        Output:
+        the number of updates made and the lower bound afterwards
+        """
+        if self.z_path is not None:
+            raise ValueError("accelerate does not support a memory-mapped Z")
+        x0 = self.get_state()
+        self.update_params()
+        x1 = self.get_state()
+        self.update_params()
+        x2 = self.get_state()
+        if not len(x0) == len(x1) == len(x2):
+            # factors were dropped
+            return 2, self.step("bound", self.bound)
+
+        Z_cov = self.sigma_Z, self.logdet_sigma_Z
+        if self.missing:
+            Z_cov_p = self.sigma_Z_p
+        r = x1 - x0
+        v = x2 - x1 - r
+        # a step of -1 gives x2 itself
+        step = min(-np.linalg.norm(r) / max(np.linalg.norm(v), 1e-300), -1.0)
+        self.set_state(x0 - 2*step*r + step**2 * v)
+        # the extrapolated parameters should not drop factors of x2
+        drop_factors, self.drop_factors = self.drop_factors, False
+        try:
+            with np.errstate(over="ignore", invalid="ignore"):
+                self.update_params()
+                bound = self.step("bound", self.bound)
+        except np.linalg.LinAlgError:
+            bound = -np.inf
+        finally:
+            self.drop_factors = drop_factors
+        if bound >= self.cost[-1]:
+            return 3, bound
 
         if self.debug:
-            print("Took {} iterations".format(i+1))
-            print("Maximal lower bound: {}".format(self.cost[i]))
+            print("Extrapolation decreased the bound, falling back")
+        self.set_state(x2)
+        self.sigma_Z, self.logdet_sigma_Z = Z_cov
+        if self.missing:
+            self.sigma_Z_p = Z_cov_p
+        self.update_params()
+        return 4, self.step("bound", self.bound)
+
+    def fit_svi(self, X, D, batch_size=256, delay=1.0, forget=0.6, bound_every=10):
+        """Infer latent variables by stochastic variational inference
+
+        Each of the max_iter steps updates q(Z) for a random minibatch of
+        samples, takes a natural gradient step on q(W) and q(tau) using the
+        minibatch statistics scaled up to N samples, and re-optimizes alpha.
+
+        Input:
+        X, D: as for fit
+        batch_size: number of samples in each minibatch
+        delay, forget: the step size at step t is (t + delay)^-forget,
+                       with forget in (0.5, 1] for convergence
+        bound_every: estimate the lower bound from the minibatch every
+                     bound_every steps (stored in cost)
+
+        Output:
+        After running, the inferred parameters will be available as fields;
+        E[Z] is computed for all samples at the end
+        """
+        self.init(X,D)
+        if self.missing:
+            raise ValueError("fit_svi does not support missing values")
+        B = min(batch_size, self.N)
+        scale = self.N / B
+
+        self.cost = []
+        for t in range(self.max_iter):
+            # the first step has nothing to average with
+            rho = 1.0 if t == 0 else (t + delay)**-forget
+            batch = np.sort(self.rng.choice(self.N, B, replace=False))
+            X_b = self._X[:, batch].astype(self.dtype, copy=False)
+
+            # local step: q(Z) for the minibatch (initial E[Z] at first)
+            if t == 0:
+                Z_b = self.m_Z[:, batch]
+            else:
+                self.sigma_Z, self.logdet_sigma_Z, P = self.Z_posterior()
+                Z_b = P @ X_b
+            Z_b = as_float64(Z_b)
+            ZZ = scale * (B * self.sigma_Z + Z_b @ Z_b.T)
+            ZX = scale * (Z_b @ as_float64(X_b).T)
+
+            # global steps
+            self.svi_update_W(ZZ, ZX, rho)
+            self.update_alpha()
+            E_X_WZ = self.E_X_WZ_stats(
+                scale * self.group_sum(np.einsum('dn,dn->d', X_b, X_b, dtype=np.float64)),
+                ZX, ZZ)
+            b_tau = self.b_tau_prior + 1/2 * E_X_WZ
+            self.b_tau = b_tau if rho == 1 else (1 - rho) * self.b_tau + rho * b_tau
+            self.first_update = False
+            self._invalidate("tau")
+
+            if (t+1) % bound_every == 0:
+                self.cost.append(self.bound_stats(E_X_WZ, ZZ))
+                if self.debug:
+                    print("Estimated lower bound at step {}: {}".format(t+1, self.cost[-1]))
+
+        self.update_Z()
+        self.n_iter = self.max_iter
+        self.converged = False
+        self.stop_reason = "max_iter"
+
+    def partial_fit(self, X_new, max_iter=10):
+        """Update a fitted model with new samples
+
+        The statistics of all samples seen so far are kept fixed, and q(Z)
+        of the new samples is fitted together with W, tau and alpha for up to
+        max_iter iterations, starting from the current W, tau and alpha.
+
+        Input:
+        X_new: data array of size d x N_new
+
+        Output:
+        After running, m_Z (and get_Z) refer to the new samples only, and
+        the lower bound in cost is for all samples seen so far
+        """
+        if not self.suff_stats:
+            raise ValueError("partial_fit requires suff_stats")
+        if self.missing:
+            raise ValueError("partial_fit does not support missing values")
+        if self.z_path is not None:
+            # E[Z] of the new samples would replace the memory-mapped one
+            raise ValueError("partial_fit does not support a memory-mapped Z")
+        assert X_new.shape[0] == self.variables
+        for start in range(0, X_new.shape[1], self.chunk_size):
+            if np.isnan(X_new[:, start:start + self.chunk_size]).any():
+                raise ValueError("partial_fit does not support missing values")
+        if not isinstance(X_new, np.memmap):
+            X_new = np.asarray(X_new, dtype=self.dtype)
+
+        # fold the current samples into the fixed statistics
+        self.prev_ZZ = self.E_ZZ()
+        self.prev_ZX = self.ZX_all()
+        self.prev_ent_Z = self.entropy_Z()
+        self.N_prev += self.N
+
+        self._X = X_new
+        self.X = np.split(X_new, self._offsets[1:])
+        self.N = X_new.shape[1]
+        self._X_sums = self.data_sums(X_new)
+        self.XX = self.XX + self._X_sums[1]
+        self.n_obs = self.n_obs + self.D * self.N
+        self.a_tau = self.a_tau_prior + self.n_obs / 2
+
+        self.m_Z = np.empty((self.factors, self.N), dtype=self.dtype)
+        self._invalidate(*self._version)
+        self.update_Z()
+        self.cost = [self.step("bound", self.bound)]
+        self.n_iter = 0
+        self.converged = False
+        if self.fit_trace is not None:
+            self.fit_trace.end_iteration(0, self.cost[0])
+        self._checkpoint_iter = 0
+        self._checkpoint_clock = time.monotonic()
+        return self.iterate(max_iter)
+
+    def warm_start(self, rank, pad_scale=1e-2):
+        """Get a copy of the fitted model with a larger rank, from which the
+        fit can be continued by iterate: Z, W, tau and alpha are kept, and U
+        and V are padded with random columns of standard deviation pad_scale
+
+        The copy shares the data (and any other array that the updates
+        replace rather than modify) with this model, and does not
+        checkpoint.
+        """
+        if rank < self.rank:
+            raise ValueError("warm_start only increases the rank")
+        if self.z_path is not None:
+            raise ValueError("warm_start does not support a memory-mapped Z")
+        g = copy.copy(self)
+        g.rank = rank
+        g.U = np.hstack([self.U, pad_scale * self.rng.normal(size=(self.groups, rank - self.rank))])
+        g.V = np.hstack([self.V, pad_scale * self.rng.normal(size=(self.factors, rank - self.rank))])
+        g.m_Z = self.m_Z.copy()
+        g.hess_inv = None
+        g.checkpoint_path = None
+        g._version = dict(self._version)
+        g._cache = {}
+        g.fit_trace = Trace(g.callback) if g.trace else None
+
+        g.cost = [g.step("bound", g.bound)]
+        g.n_iter = 0
+        g.converged = False
+        g.stop_reason = None
+        if g.fit_trace is not None:
+            g.fit_trace.end_iteration(0, g.cost[0])
+        return g
+
+    def svi_update_W(self, ZZ, ZX, rho):
+        """Take a natural gradient step of size rho on q(W), given the
+        estimates ZZ of E[Z Z.T] (size K x K) and ZX of E[Z] X.T (size K x d)
+
+        svi_prec_W : M x K x K-array with the precisions of q(W(m))
+        svi_lin_W : per-bucket G x K x Dm-arrays with tau(m) E[Z] X(m).T,
+                    the remaining natural parameter of q(W(m))
+        """
+        K = self.factors
+        tau = self.E_tau_all()
+        prec = tau[:,np.newaxis,np.newaxis] * ZZ
+        prec[:, np.arange(K), np.arange(K)] += self.alpha
+        lin = [tau[idx,np.newaxis,np.newaxis] * ZX_b
+               for idx, ZX_b in zip(self.buckets, self.split_buckets(ZX))]
+        if rho < 1:
+            prec = (1 - rho) * self.svi_prec_W + rho * prec
+            lin = [(1 - rho) * old + rho * new for old, new in zip(self.svi_lin_W, lin)]
+        self.svi_prec_W = prec
+        self.svi_lin_W = lin
+
+        self.sigma_W, self.logdet_sigma_W = chol_inv(prec)
+        self.set_m_W([self.sigma_W[idx] @ lin_b
+                      for idx, lin_b in zip(self.buckets, lin)])
+        self._invalidate("W")
+
+    def group_cols(self, groups):
+        """Get the indices of the variables (rows of X) in 'groups'"""
+        return np.concatenate([np.arange(self._offsets[m], self._offsets[m] + self.D[m])
+                               for m in groups])
+
+    def transform(self, X, observed_groups=None):
+        """Infer E[Z] for new samples from the observed groups only
+
+        Input:
+        X: data array of size d x N; the rows of unobserved groups are
+           ignored (and may be NaN)
+        observed_groups: indices of the observed groups, default all
+
+        Output:
+        E[Z], size K x N
+        """
+        if observed_groups is None:
+            observed_groups = np.arange(self.groups)
+        observed_groups = np.asarray(observed_groups)
+        tau = self.E_tau_all()[observed_groups]
+        cols = self.group_cols(observed_groups)
+
+        # (I + sum_m tau(m) E[W(m) W(m).T]) E[z_i] = sum_m tau(m) W(m) x(m)_i
+        prec = np.eye(self.factors) + np.einsum('m,mkl->kl', tau,
+                                                self.E_WW_all()[observed_groups])
+        rhs = (self.E_W_all()[:, cols] * np.repeat(tau, self.D[observed_groups])) @ X[cols]
+        return scipy.linalg.cho_solve(scipy.linalg.cho_factor(prec), rhs)
+
+    def predict(self, X, observed_groups, target_groups=None):
+        """Predict the target groups of new samples from the observed groups
+
+        Input:
+        X: data array of size d x N; only the rows of the observed groups are
+           used (the others may be NaN)
+        observed_groups: indices of the observed groups
+        target_groups: indices of the groups to predict, default all groups
+                       that are not observed
+
+        Output:
+        E[W(target).T z_i] for all samples, size d_target x N, with the
+        target groups in the order given
+        """
+        if target_groups is None:
+            target_groups = np.setdiff1d(np.arange(self.groups), observed_groups)
+        W = self.E_W_all()[:, self.group_cols(target_groups)]
+        return W.T @ self.transform(X, observed_groups)
+
+    def predict_loo(self, X):
+        """Predict every group of new samples from all the other groups
+
+        The precision I + sum_m tau(m) E[W(m) W(m).T] and the projection
+        sum_m tau(m) W(m) x(m)_i are computed once, and for each group only
+        its own term is subtracted from them (a rank-Dm downdate of the
+        projection and a K x K downdate of the precision).
+
+        Input:
+        X: data array of size d x N
+
+        Output:
+        the predictions, size d x N, where the rows of each group are
+        predicted from all other groups, and the RMSE of each group (size M)
+        """
+        tau = self.E_tau_all()
+        E_WW = self.E_WW_all()
+        prec = np.eye(self.factors) + np.einsum('m,mkl->kl', tau, E_WW)
+        sigma, _ = chol_inv(prec - tau[:,np.newaxis,np.newaxis] * E_WW)
+        h = (self.E_W_all() * np.repeat(tau, self.D)) @ X
+
+        pred = np.empty(X.shape)
+        for idx, cols, m_W in zip(self.buckets, self._bucket_cols, self._m_W):
+            # W(m).T sigma(-m) (h - tau(m) W(m) x(m)_i)
+            A = np.swapaxes(m_W, 1, 2) @ sigma[idx]
+            X_b = X[cols].reshape(len(idx), -1, X.shape[1])
+            pred_b = A @ h - tau[idx,np.newaxis,np.newaxis] * (A @ m_W) @ X_b
+            pred[cols] = pred_b.reshape(-1, X.shape[1])
+
+        rmse = np.sqrt(self.group_sum(np.sum((X - pred)**2, axis=1)) / (self.D * X.shape[1]))
+        return pred, rmse
 
     def get_bounds(self):
         return self.cost
 
     def update_params(self):
-        self.update_W()
-        self.update_Z()
-        self.update_alpha()
-        self.update_tau()
+        if self.drop_factors:
+            self.prune_factors()
+        self.step("update_W", self.update_W)
+        self.step("update_Z", self.update_Z)
+        # the rotation assumes that alpha can follow it freely
+        if self.rotate and not self.first_update and self.full_rank():
+            self.step("update_rotation", self.update_rotation)
+        self.step("update_alpha", self.update_alpha)
+        self.step("update_tau", self.update_tau)
+
+    def step(self, name, update):
+        """Call 'update', timing it in fit_trace under 'name' if tracing"""
+        if self.fit_trace is None:
+            return update()
+        start = time.perf_counter()
+        result = update()
+        self.fit_trace.add(name, time.perf_counter() - start, result)
+        return result
+
+    def init(self, X, D, mask=None):
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode="r")
+        if isinstance(X, np.memmap) or self.z_path is not None:
+            # out of core: only ever touch X and Z one chunk at a time
+            self.low_mem = self.suff_stats = True
 
-    def init(self, X, D):
         D = D.astype(int)
         assert D.sum() == X.shape[0]
+        if not isinstance(X, np.memmap):
+            # memory-mapped data is converted one chunk at a time instead
+            X = np.asarray(X, dtype=self.dtype)
+
+        if mask is None:
+            # only build the full mask if there are missing values at all
+            # (scanning memory-mapped data one chunk at a time too)
+            if any(np.isnan(X[:, start:start + self.chunk_size]).any()
+                   for start in range(0, X.shape[1], self.chunk_size)):
+                if self.low_mem:
+                    raise ValueError("missing values are not supported with low_mem")
+                mask = ~np.isnan(X)
+        self.missing = mask is not None and not mask.all()
+        if self.missing:
+            if self.low_mem:
+                raise ValueError("missing values are not supported with low_mem")
+            if self.rotate:
+                raise ValueError("missing values are not supported with rotate")
+            # the missing entries contribute nothing to E[Z] X.T and ||X||^2
+            X = np.where(mask, X, 0)
+            self.suff_stats = True
 
         self.groups = len(D)
         self.variables = X.shape[0]
@@ -110,14 +1101,49 @@ class GFA:
         self.X = np.split(X, split_indices)
         self.D = D
         self.N = X.shape[1]
+        self._X = X
+
+        # bucket groups of equal size, so that the per-group updates can be
+        # done with stacked (batched) arrays instead of looping over groups
+        self._offsets = np.concatenate([[0], split_indices])
+        self.buckets = [np.flatnonzero(D == Dm) for Dm in np.unique(D)]
+        self._bucket_cols = [
+            np.concatenate([np.arange(self._offsets[m], self._offsets[m] + D[m])
+                            for m in idx])
+            for idx in self.buckets]
+
+        if self.missing:
+            self.init_missing(mask)
+        else:
+            self.n_obs = self.D * self.N
+
+        # the sums and sums of squares of the groups of X, which also tell
+        # checkpoints of other data apart
+        self._X_sums = self.data_sums(X)
+        if self.suff_stats:
+            # ||X(m)||^2, the only statistic of X needed besides E[Z] X(m).T
+            self.XX = self._X_sums[1]
+        if self.low_mem or self.missing:
+            mean = self._X_sums[0] / self.n_obs
+            datavar = self._X_sums[1] / self.n_obs - mean**2
+        else:
+            datavar = [self.X[m].var(dtype=np.float64) for m in range(self.groups)]
 
-        datavar = [self.X[m].var() for m in range(self.groups)]
+        # the options defining the fit, see fingerprint
+        self._options = {name: getattr(self, name) for name in FINGERPRINT_OPTIONS}
+        if isinstance(self.random_state, np.random.Generator):
+            # a generator has no description that outlives the process
+            self._options["random_state"] = None
+
+        if self.random_state is None:
+            rng = np.random
+        else:
+            rng = np.random.default_rng(self.random_state)
+        self.rng = rng
 
         # initialize alpha
-        self.U = np.random.normal(loc=0, scale=1,
-                                  size=(self.groups, self.rank))
-        self.V = np.random.normal(loc=0, scale=1,
-                                  size=(self.factors, self.rank))
+        self.U = rng.normal(loc=0, scale=1, size=(self.groups, self.rank))
+        self.V = rng.normal(loc=0, scale=1, size=(self.factors, self.rank))
         self.mu_u = np.zeros((self.groups, 1))
         self.mu_v = np.zeros((self.factors, 1))
         self.alpha = self.get_alpha()
@@ -126,17 +1152,175 @@ class GFA:
 
         # initialize q(tau)
         # a_tau is constant; set b_tau to a_tau so that E[tau] = 1
-        self.a_tau = self.a_tau_prior + self.D * self.N / 2
+        self.a_tau = self.a_tau_prior + self.n_obs / 2
         self.b_tau = self.a_tau
 
         # initialize q(Z)
         # TODO: investigate effect of initialization
         self.sigma_Z = np.eye(self.factors)
-        self.m_Z = np.random.randn(self.factors, self.N)
+        self.logdet_sigma_Z = 0.0
+        if self.missing:
+            self.sigma_Z_p = np.tile(self.sigma_Z, (len(self.sample_idx), 1, 1))
+        if self.z_path is None:
+            self.m_Z = rng.standard_normal((self.factors, self.N)).astype(self.dtype, copy=False)
+        else:
+            self.m_Z = np.lib.format.open_memmap(self.z_path, mode="w+", dtype=self.dtype,
+                                                 shape=(self.factors, self.N))
+            for chunk in self.chunks():
+                self.m_Z[:, chunk] = rng.standard_normal(self.m_Z[:, chunk].shape)
 
         # return a initial value for tau
         self.first_update = True
 
+        # inverse Hessian estimate carried between updates of alpha
+        self.hess_inv = None
+
+        self.fit_trace = Trace(self.callback) if self.trace else None
+
+        # statistics of the samples of earlier batches, see partial_fit
+        self.N_prev = 0
+        self.prev_ZZ = 0
+        self.prev_ZX = 0
+        self.prev_ent_Z = 0
+
+        # moment cache, see _cached
+        self._version = {"W": 0, "Z": 0, "tau": 0, "alpha": 0}
+        self._cache = {}
+
+    def init_missing(self, mask):
+        """Group the samples, and the variables of each group, by their
+        pattern of missing values, so that the covariances of q(z_i) and
+        q(w_d) are computed once per pattern
+
+        sample_idx : P-sized list with the samples of each pattern
+        row_idx : Q-sized list with the variables of each pattern
+        row_group : Q-sized vector with the group of each pattern of variables
+        pattern_obs : Q x P-array, 1 where the samples of pattern p observe
+                      the variables of pattern q
+        n_obs : M-sized vector with the number of observed entries of X(m)
+        """
+        first = mask[self._offsets]
+        if np.array_equal(np.repeat(first, self.D, axis=0), mask):
+            # only whole groups are missing: a single pattern of variables
+            # per group, and the samples only differ in M entries
+            patterns, sample_pattern = np.unique(first.T, axis=0, return_inverse=True)
+            self.row_group = np.arange(self.groups)
+            row_pattern = np.repeat(self.row_group, self.D)
+            self.pattern_obs = patterns.T.astype(float)
+        else:
+            patterns, sample_pattern = np.unique(mask.T, axis=0, return_inverse=True)
+            group = np.repeat(np.arange(self.groups), self.D)
+            rows, first_row, row_pattern = np.unique(
+                np.column_stack([group, mask]), axis=0,
+                return_index=True, return_inverse=True)
+            self.row_group = rows[:, 0]
+            self.pattern_obs = patterns[:, first_row].T.astype(float)
+
+        sample_pattern = sample_pattern.ravel()
+        row_pattern = row_pattern.ravel()
+        self.sample_count = np.bincount(sample_pattern)
+        self.sample_idx = np.split(np.argsort(sample_pattern, kind="stable"),
+                                   np.cumsum(self.sample_count)[:-1])
+        self.row_count = np.bincount(row_pattern)
+        self.row_idx = np.split(np.argsort(row_pattern, kind="stable"),
+                                np.cumsum(self.row_count)[:-1])
+        self.n_obs = self.group_sum(mask.sum(axis=1))
+
+    def _invalidate(self, *params):
+        """Mark the parameters in 'params' as changed, so that cached
+        moments depending on them are recomputed on next access"""
+        for param in params:
+            self._version[param] += 1
+
+    def _cached(self, key, deps, compute):
+        """Return the moment stored under 'key', calling 'compute' only if
+        any of the parameters in 'deps' has changed since it was stored"""
+        stamp = tuple(self._version[dep] for dep in deps)
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, compute())
+            self._cache[key] = entry
+        return entry[1]
+
+    def chunks(self, stats=False):
+        """Iterate over the slices of samples processed together, which is
+        all of them unless low_mem is set
+
+        With stats, the slices over which the statistics of the bound are
+        summed: these are computed in float64 (as E[Z] X.T and E[Z] E[Z].T
+        cancel in E_X_WZ), so for another dtype the float64 copies are
+        limited to chunk_size samples
+        """
+        if not self.low_mem and (not stats or self.dtype == np.float64):
+            yield slice(None)
+            return
+        for start in range(0, self.N, self.chunk_size):
+            yield slice(start, start + self.chunk_size)
+
+    def split_buckets(self, A):
+        """Split a K x d matrix into the stacked G x K x Dm arrays of the
+        groups in each bucket"""
+        return [A[:, cols].reshape(A.shape[0], len(idx), -1).transpose(1, 0, 2)
+                for idx, cols in zip(self.buckets, self._bucket_cols)]
+
+    def data_sums(self, X):
+        """Calculate the sums and the sums of squares of the entries of each
+        group of X (d x N), one chunk at a time
+
+        Output:
+        array of size 2 x M
+        """
+        sums = np.zeros((2, self.variables))
+        for chunk in self.chunks():
+            X_c = X[:, chunk]
+            sums[0] += X_c.sum(axis=1, dtype=np.float64)
+            sums[1] += np.einsum('dn,dn->d', X_c, X_c, dtype=np.float64)
+        return self.group_sum(sums)
+
+    def group_sum(self, x):
+        """Sum a vector (or the columns of a matrix) of size d over the
+        variables of each group"""
+        return np.add.reduceat(x, self._offsets, axis=-1)
+
+    def prune_factors(self):
+        """Remove the factors that have been shut off, i.e. whose latent
+        variables have mean square below drop_tol"""
+        Z_sq = sum(np.einsum('kn,kn->k', self.m_Z[:, chunk], self.m_Z[:, chunk])
+                   for chunk in self.chunks())
+        keep = np.flatnonzero(Z_sq / self.N > self.drop_tol)
+        if len(keep) == self.factors:
+            return
+        if len(keep) == 0:
+            raise Exception("Shut down all components, no structure found in the data.")
+        if self.debug:
+            print("Dropping {} factors".format(self.factors - len(keep)))
+
+        self.factors = len(keep)
+        if not self.low_mem:
+            self.m_Z = self.m_Z[keep]
+        else:
+            # compact the kept rows in place (keep is increasing)
+            for chunk in self.chunks():
+                self.m_Z[:len(keep), chunk] = self.m_Z[keep, chunk]
+            self.m_Z = self.m_Z[:len(keep)]
+        self.sigma_Z = self.sigma_Z[np.ix_(keep, keep)]
+        self.logdet_sigma_Z = np.linalg.slogdet(self.sigma_Z)[1]
+        if self.missing:
+            self.sigma_Z_p = self.sigma_Z_p[:, keep[:,np.newaxis], keep]
+        if hasattr(self, "m_W"):
+            if self.missing:
+                self.sigma_W_rows = self.sigma_W_rows[:, keep[:,np.newaxis], keep]
+            self.sigma_W = self.sigma_W[:, keep[:,np.newaxis], keep]
+            self.logdet_sigma_W = np.linalg.slogdet(self.sigma_W)[1]
+            self.set_m_W([m_W[:, keep] for m_W in self._m_W])
+        if self.N_prev:
+            self.prev_ZZ = self.prev_ZZ[np.ix_(keep, keep)]
+            self.prev_ZX = self.prev_ZX[keep]
+        self.V = self.V[keep]
+        self.mu_v = self.mu_v[keep]
+        self.alpha = self.alpha[:, keep]
+        self._invalidate(*self._version)
+
     def get_W(self):
         return np.hstack([self.E_W(m) for m in range(self.groups)])
 
@@ -149,19 +1333,27 @@ class GFA:
     def bound(self):
         """Get current lower bound of marginal p(Y)
            (may ignore constants with respect to parameters)"""
+        return self.bound_stats(self.E_X_WZ_all(), self.E_ZZ())
+
+    def bound_stats(self, E_X_WZ, E_ZZ):
+        """Get the lower bound given the sample-dependent expectations
+        E_X_WZ (size M) and E_ZZ (size K x K), which can also be minibatch
+        estimates scaled up to N samples"""
+
+        tau = self.E_tau_all()
+        logtau = self.E_logtau_all()
 
         # calculate E[log p(X, Theta)]
-        p_X = sum(self.N * self.D[m]/2 * (self.E_logtau(m) - np.log(2*np.pi))
-                  - self.E_tau(m)/2 * self.E_X_WZ(m)
-                  for m in range(self.groups))
+        N = self.N + self.N_prev
+        p_X = np.sum(self.n_obs/2 * (logtau - np.log(2*np.pi))
+                     - tau/2 * E_X_WZ)
 
-        p_Z = -self.N*self.factors/2 * np.log(2*np.pi) - 1/2 * np.trace(self.E_ZZ())
+        p_Z = -N*self.factors/2 * np.log(2*np.pi) - 1/2 * np.trace(E_ZZ)
 
-        p_tau = sum(self.a_tau_prior * np.log(self.b_tau_prior)
-                    - scipy.special.gammaln(self.a_tau_prior)
-                    + (self.a_tau_prior - 1) * self.E_logtau(m)
-                    - self.b_tau_prior * self.E_tau(m)
-                    for m in range(self.groups))
+        p_tau = np.sum(self.a_tau_prior * np.log(self.b_tau_prior)
+                       - scipy.special.gammaln(self.a_tau_prior)
+                       + (self.a_tau_prior - 1) * logtau
+                       - self.b_tau_prior * tau)
 
         p_W = 1/2 * (self.D @ np.sum(np.log(self.alpha), axis=1)
                      - self.factors*self.variables*np.log(2*np.pi)
@@ -175,21 +1367,23 @@ class GFA:
         p = p_X + p_Z + p_tau + p_W + p_U + p_V
 
         # calculate E[-log q(Theta)] (entropy)
-        ent_Z = self.N/2 * np.log((2*np.pi*np.e)**self.factors
-                                  * np.linalg.det(self.sigma_Z))
+        ent_Z = self.entropy_Z()
 
-        ent_tau = sum(self.a_tau[m] - np.log(self.b_tau[m])
-                      + scipy.special.gammaln(self.a_tau[m])
-                      + (1 - self.a_tau[m]) * scipy.special.digamma(self.a_tau[m])
-                      for m in range(self.groups))
+        ent_tau = np.sum(self.a_tau - np.log(self.b_tau)
+                         + scipy.special.gammaln(self.a_tau)
+                         + (1 - self.a_tau) * scipy.special.digamma(self.a_tau))
 
-        ent_W = sum(self.D[m]/2 * np.log((2*np.pi*np.e)**self.factors
-                                          * np.linalg.det(self.sigma_W[m]))
-                    for m in range(self.groups))
+        ent_W = np.sum(self.D/2 * (self.factors * np.log(2*np.pi*np.e)
+                                   + self.logdet_sigma_W))
 
         ent = ent_Z + ent_tau + ent_W
         return p + ent
 
+    def entropy_Z(self):
+        """Calculate the entropy of q(Z)"""
+        return (self.N/2 * (self.factors * np.log(2*np.pi*np.e) + self.logdet_sigma_Z)
+                + self.prev_ent_Z)
+
     # NOTE: all expectations with regard to q
     def E_tau(self, m):
         """Calculate E[tau(m)]"""
@@ -198,10 +1392,25 @@ class GFA:
         else:
             return self.a_tau[m] / self.b_tau[m]
 
+    def E_tau_all(self):
+        """Calculate E[tau(m)] for all groups
+        Size = M
+        """
+        if self.first_update:
+            return np.full(self.groups, float(self.init_tau))
+        else:
+            return self.a_tau / self.b_tau
+
     def E_logtau(self, m):
         """Calculate E[log tau(m)]"""
         return scipy.special.digamma(self.a_tau[m]) - np.log(self.b_tau[m])
 
+    def E_logtau_all(self):
+        """Calculate E[log tau(m)] for all groups
+        Size = M
+        """
+        return scipy.special.digamma(self.a_tau) - np.log(self.b_tau)
+
     def E_W(self, m):
         """Calculate E[W(m)]"""
         return self.m_W[m]
@@ -209,17 +1418,35 @@ class GFA:
     def Cov_W(self, m):
         return self.D[m] * self.sigma_W[m]
 
+    def E_W_all(self):
+        """Calculate E[W] for all groups, stacked horizontally
+        Size = K x d
+        """
+        return self._cached("E_W_all", ("W",), self.get_W)
+
     def E_WW(self, m):
         """Calculate E[W(m) W(m).T]
         Size = K x K
         """
-        return self.Cov_W(m) + self.m_W[m] @ self.m_W[m].T
+        return self.E_WW_all()[m]
+
+    def E_WW_all(self):
+        """Calculate E[W(m) W(m).T] for all groups
+        Size = M x K x K
+        """
+        def compute():
+            WW = self.D[:,np.newaxis,np.newaxis] * self.sigma_W
+            for idx, m_W in zip(self.buckets, self._m_W):
+                m_W = as_float64(m_W)
+                WW[idx] += m_W @ m_W.transpose(0, 2, 1)
+            return WW
+        return self._cached("E_WW", ("W",), compute)
 
     def E_WW_diag(self):
         """Calculate diagonal of E_WW for all groups
         Size = M x K
         """
-        return np.array([np.diag(self.E_WW(m)) for m in range(self.groups)])
+        return np.diagonal(self.E_WW_all(), axis1=1, axis2=2)
 
     def E_Z(self):
         """Calculate E[Z]"""
@@ -228,36 +1455,271 @@ class GFA:
     def Cov_Z(self):
         return self.N * self.sigma_Z
 
+    def ZZ_mean(self):
+        """Calculate E[Z] E[Z].T"""
+        return self._cached("ZZ_mean", ("Z",), lambda: sum(
+            as_float64(self.m_Z[:, chunk]) @ as_float64(self.m_Z[:, chunk]).T
+            for chunk in self.chunks(stats=True)))
+
     def E_ZZ(self):
         """Calculate E[Z Z.T]"""
-        return self.Cov_Z() + self.m_Z @ self.m_Z.T
+        return self._cached("E_ZZ", ("Z",),
+                            lambda: self.Cov_Z() + self.ZZ_mean() + self.prev_ZZ)
+
+    def E_ZZ_patterns(self):
+        """Calculate E[Z Z.T] over the samples of each missingness pattern
+        Size = P x K x K
+        """
+        def compute():
+            ZZ = self.sample_count[:,np.newaxis,np.newaxis] * self.sigma_Z_p
+            for p, idx in enumerate(self.sample_idx):
+                Z_p = as_float64(self.m_Z[:, idx])
+                ZZ[p] += Z_p @ Z_p.T
+            return ZZ
+        return self._cached("E_ZZ_patterns", ("Z",), compute)
+
+    def E_ZZ_rows(self):
+        """Calculate E[Z Z.T] over the samples observing the variables of
+        each pattern
+        Size = Q x K x K
+        """
+        return self._cached("E_ZZ_rows", ("Z",), lambda: np.einsum(
+            'qp,pkl->qkl', self.pattern_obs, self.E_ZZ_patterns()))
+
+    def E_WW_rows(self):
+        """Calculate E[W W.T] over the variables of each missingness pattern
+        Size = Q x K x K
+        """
+        def compute():
+            if len(self.row_idx) == self.groups:
+                return self.E_WW_all()
+            W = self.E_W_all()
+            WW = self.row_count[:,np.newaxis,np.newaxis] * self.sigma_W_rows
+            for q, idx in enumerate(self.row_idx):
+                W_q = as_float64(W[:, idx])
+                WW[q] += W_q @ W_q.T
+            return WW
+        return self._cached("E_WW_rows", ("W",), compute)
+
+    def ZX(self, m):
+        """Calculate E[Z] X(m).T
+        Size = K x Dm
+        """
+        return self.ZX_all()[:, self._offsets[m]:self._offsets[m] + self.D[m]]
+
+    def ZX_all(self):
+        """Calculate E[Z] X.T
+        Size = K x d
+        """
+        return self._cached("ZX", ("Z",), lambda: sum(
+            as_float64(self.m_Z[:, chunk]) @ as_float64(self._X[:, chunk]).T
+            for chunk in self.chunks(stats=True))
+                            + self.prev_ZX)
 
     def E_X_WZ(self, m):
         """Calculate sum_i E[(x(m)_i - W(m).T z_i)^2]"""
-        return (trprod(self.E_WW(m), self.Cov_Z()) +
-                trprod(self.Cov_W(m), self.E_Z() @ self.E_Z().T) +
-                ((self.E_W(m).T @ self.E_Z() - self.X[m])**2).sum())
+        return self.E_X_WZ_all()[m]
+
+    def E_X_WZ_stats(self, XX, ZX, ZZ):
+        """Calculate E_X_WZ for all groups from the statistics ||X(m)||^2
+        (size M), E[Z] X.T (size K x d) and E[Z Z.T] (size K x K)"""
+        # expand the square: ||X||^2 - 2 tr(W ZX) + tr(E[WW] E[ZZ])
+        return (XX - 2 * self.group_sum(np.sum(self.E_W_all() * ZX, axis=0,
+                                               dtype=np.float64)) +
+                np.einsum('mkl,lk->m', self.E_WW_all(), ZZ))
+
+    def E_X_WZ_all(self):
+        """Calculate E_X_WZ for all groups
+        Size = M
+        """
+        if self.missing:
+            # the second moments differ between patterns of missing values
+            return self._cached("E_X_WZ", ("W", "Z"), lambda: (
+                self.XX - 2 * self.group_sum(np.sum(self.E_W_all() * self.ZX_all(), axis=0,
+                                                    dtype=np.float64))
+                + np.bincount(self.row_group, np.einsum(
+                    'qkl,qlk->q', self.E_WW_rows(), self.E_ZZ_rows()),
+                              minlength=self.groups)))
+        if self.suff_stats:
+            return self._cached("E_X_WZ", ("W", "Z"), lambda: self.E_X_WZ_stats(
+                self.XX, self.ZX_all(), self.E_ZZ()))
+        return self._cached("E_X_WZ", ("W", "Z"), lambda: np.array([
+            trprod(self.E_WW(m), self.Cov_Z()) +
+            trprod(self.Cov_W(m), self.ZZ_mean()) +
+            ((self.E_W(m).T @ self.E_Z() - self.X[m])**2).sum(dtype=np.float64)
+            for m in range(self.groups)]))
 
     # TODO: document simplification of formulas
     def update_W(self):
         """Update W, i.e. update the mean m_W and covariance sigma_W
         of variational distribution
 
-        sigma_W : M-sized vector with K x K-arrays
+        sigma_W : M x K x K-array
         m_W : M-sized vector with K x Dm-arrays, Dm = dimentionality of group
+              (views into _m_W, which stacks the groups of each bucket)
+        logdet_sigma_W : M-sized vector with log|sigma_W(m)|
+        """
+        if self.missing:
+            return self.update_W_missing()
+        tau = self.E_tau_all()
+        self.sigma_W, self.logdet_sigma_W = self.W_posterior(tau, self.alpha, self.E_ZZ())
+        self.set_m_W([tau[idx,np.newaxis,np.newaxis] * self.sigma_W[idx] @ ZX_b
+                      for idx, ZX_b in zip(self.buckets, self.split_buckets(self.ZX_all()))])
+        self._invalidate("W")
+
+    def update_W_missing(self):
+        """Update W when X has missing values, with one covariance of q(w_d)
+        for each pattern of missing values (sigma_W_rows, Q x K x K-array)
+
+        sigma_W and logdet_sigma_W are averaged over the variables of each
+        group, which is all that E_WW_all and the entropy of q(W) need
         """
-        self.sigma_W = [
-            np.linalg.inv(self.E_tau(m) * self.E_ZZ() + np.diag(self.alpha[m]))
-            for m in range(self.groups)]
-        self.m_W = [self.E_tau(m) * self.sigma_W[m] @ self.E_Z() @ self.X[m].T
-                    for m in range(self.groups)]
+        K = self.factors
+        tau = self.E_tau_all()[self.row_group]
+        self.sigma_W_rows, logdet = self.W_posterior(
+            tau, self.alpha[self.row_group], self.E_ZZ_rows())
+        ZX = self.ZX_all()
+        W = np.empty((K, self.variables), dtype=self.dtype)
+        for q, idx in enumerate(self.row_idx):
+            W[:, idx] = tau[q] * self.sigma_W_rows[q] @ ZX[:, idx]
+
+        weight = self.row_count / self.D[self.row_group]
+        self.sigma_W = np.zeros((self.groups, K, K))
+        np.add.at(self.sigma_W, self.row_group,
+                  weight[:,np.newaxis,np.newaxis] * self.sigma_W_rows)
+        self.logdet_sigma_W = np.bincount(self.row_group, weight * logdet,
+                                          minlength=self.groups)
+        self.set_m_W(self.split_buckets(W))
+        self._invalidate("W")
+
+    def W_posterior(self, tau, alpha, ZZ):
+        """Calculate the covariances of q(w) and their log-determinants for
+        noise precisions tau (size n), ARD precisions alpha (size n x K) and
+        second moments E[Z Z.T] ZZ (size K x K or n x K x K)"""
+        K = self.factors
+        # factorize alpha^-1/2 (tau E[ZZ] + diag(alpha)) alpha^-1/2 / tau
+        # like the reference implementation, which stays well conditioned
+        # when alpha spans many orders of magnitude
+        scale = 1 / np.sqrt(alpha)
+        outer = scale[:,:,np.newaxis] * scale[:,np.newaxis,:]
+        prec = outer * ZZ
+        prec[:, np.arange(K), np.arange(K)] += 1 / tau[:,np.newaxis]
+        cov, logdet = chol_inv(prec)
+        return (outer * cov / tau[:,np.newaxis,np.newaxis],
+                logdet - np.log(alpha).sum(axis=1) - K * np.log(tau))
+
+    def set_m_W(self, m_Ws):
+        """Set the means of W from the stacked G x K x Dm arrays of each bucket"""
+        self._m_W = m_Ws = [m_W.astype(self.dtype, copy=False) for m_W in m_Ws]
+        self.m_W = [None] * self.groups
+        for idx, m_W in zip(self.buckets, m_Ws):
+            for i, m in enumerate(idx):
+                self.m_W[m] = m_W[i]
+
+    def Z_posterior(self):
+        """Calculate the covariance of q(z_i), which is shared by all
+        samples, its log-determinant, and the K x d projection P such that
+        E[z_i] = P x_i"""
+        tau = self.E_tau_all()
+        sigma_Z, logdet = chol_inv(
+            np.eye(self.factors) + np.einsum('m,mkl->kl', tau, self.E_WW_all()))
+        # E[z_i] = sigma_Z sum_m tau(m) W(m) x(m)_i
+        P = sigma_Z @ (self.E_W_all() * np.repeat(tau, self.D))
+        return sigma_Z, logdet, P.astype(self.dtype, copy=False)
 
     def update_Z(self):
-        self.sigma_Z = np.linalg.inv(np.eye(self.factors) +
-                                     sum(self.E_tau(m) * self.E_WW(m)
-                                         for m in range(self.groups)))
-        self.m_Z = self.sigma_Z @ sum(self.E_tau(m) * self.E_W(m) @ self.X[m]
-                                      for m in range(self.groups))
+        if self.missing:
+            return self.update_Z_missing()
+        self.sigma_Z, self.logdet_sigma_Z, P = self.Z_posterior()
+        if not self.low_mem:
+            self.m_Z = P @ self._X
+        else:
+            # one chunk of samples at a time
+            for chunk in self.chunks():
+                self.m_Z[:, chunk] = P @ self._X[:, chunk].astype(self.dtype, copy=False)
+        self._invalidate("Z")
+
+    def update_Z_missing(self):
+        """Update Z when X has missing values, with one covariance of q(z_i)
+        for each pattern of missing values (sigma_Z_p, P x K x K-array)
+
+        sigma_Z and logdet_sigma_Z are averaged over the samples
+        """
+        tau = self.E_tau_all()
+        prec = np.eye(self.factors) + np.einsum(
+            'qp,q,qkl->pkl', self.pattern_obs, tau[self.row_group], self.E_WW_rows())
+        self.sigma_Z_p, logdet = chol_inv(prec)
+        # the missing entries of X are zero
+        self.m_Z = (self.E_W_all() * np.repeat(tau, self.D).astype(self.dtype)) @ self._X
+        for p, idx in enumerate(self.sample_idx):
+            self.m_Z[:, idx] = self.sigma_Z_p[p] @ self.m_Z[:, idx]
+
+        self.sigma_Z = np.einsum('p,pkl->kl', self.sample_count, self.sigma_Z_p) / self.N
+        self.logdet_sigma_Z = self.sample_count @ logdet / self.N
+        self._invalidate("Z")
+
+    def rotation_bound(self, r):
+        """Return the (negated) lower bound and its gradient as function of
+        a linear transformation R of the factors (Z -> R^-1 Z, W -> R.T W),
+        ignoring constant terms and assuming that alpha is updated
+        optimally afterwards (E and gradE in the reference implementation)
+        """
+        K = self.factors
+        N = self.N + self.N_prev
+        R = r.reshape(K, K)
+        u, d, vt = np.linalg.svd(R)
+        RR_inv = (u / d**2) @ u.T
+        R_inv = (vt.T / d) @ u.T
+        WW_R = self.E_WW_all() @ R
+        diag_RWWR = np.sum(R * WW_R, axis=1)
+
+        bound = (-trprod(self.E_ZZ(), RR_inv)/2
+                 + (self.variables - N) * np.sum(np.log(d))
+                 - np.sum(self.D[:,np.newaxis] * np.log(diag_RWWR))/2)
+        grad = ((RR_inv @ self.E_ZZ() + (self.variables - N) * np.eye(K)) @ R_inv.T
+                - np.einsum('m,mkl->kl', self.D, WW_R / diag_RWWR[:,np.newaxis,:]))
+
+        return -bound, -grad.ravel()
+
+    def update_rotation(self):
+        """Rotate Z and W by the transformation maximizing the lower bound,
+        starting the optimization from the identity (no rotation)
+
+        Output:
+        returns an OptimizeResult from scipy for debugging purposes
+        """
+        K = self.factors
+        try:
+            res = opt.minimize(self.rotation_bound, np.eye(K).ravel(), jac=True,
+                               method=self.rotate_method,
+                               options={"maxiter":self.rotate_iter})
+            R = res.x.reshape(K, K)
+            u, d, vt = np.linalg.svd(R)
+        except np.linalg.LinAlgError:
+            res = None
+        if res is None or not np.isfinite(res.fun) or not np.all(d > 0):
+            # as in the reference, give up on rotating for the rest of the fit
+            print("Failure in optimizing the rotation. Turning the rotation off.")
+            self.rotate = False
+            return res
+
+        R_inv = (vt.T / d) @ u.T
+        logdet = np.sum(np.log(d))
+
+        for chunk in self.chunks():
+            self.m_Z[:, chunk] = R_inv.astype(self.dtype) @ self.m_Z[:, chunk]
+        self.sigma_Z = R_inv @ self.sigma_Z @ R_inv.T
+        self.logdet_sigma_Z -= 2 * logdet
+        if self.N_prev:
+            self.prev_ZZ = R_inv @ self.prev_ZZ @ R_inv.T
+            self.prev_ZX = R_inv @ self.prev_ZX
+            self.prev_ent_Z -= self.N_prev * logdet
+        self.set_m_W([R.T @ m_W for m_W in self._m_W])
+        self.sigma_W = R.T @ self.sigma_W @ R
+        self.logdet_sigma_W += 2 * logdet
+        self._invalidate("W", "Z")
+
+        return res
 
     def ln_alpha(self, U, V, mu_u, mu_v):
         # this is equivalent to the original formula thanks to broadcasting
@@ -273,32 +1735,39 @@ class GFA:
         return split_and_reshape(x, (self.groups, self.rank), (self.factors, self.rank),
                                  (self.groups, 1), (self.factors, 1))
 
-    def bound_uv(self, x):
+    def bound_grad_uv(self, x, WW_diag=None):
         """Return the lower bound as function of U,V,mu_u,mu_v
-        ignoring constant terms"""
+        ignoring constant terms, together with its gradient
+
+        WW_diag: E_WW_diag(), which can be passed in when evaluating
+                 repeatedly
+        """
+        if WW_diag is None:
+            WW_diag = self.E_WW_diag()
 
         U, V, mu_u, mu_v = self.recover_matrices(x)
         ln_alpha = self.ln_alpha(U, V, mu_u, mu_v)
-        alpha = np.exp(ln_alpha)
+        WW_alpha = WW_diag * np.exp(ln_alpha)
 
-        bound = (sum((self.D[m] * ln_alpha[m,:] - np.diag(self.E_WW(m)) * alpha[m,:]).sum()
-                     for m in range(self.groups)) -
+        bound = ((self.D[:,np.newaxis] * ln_alpha - WW_alpha).sum() -
                  self.lamb * (np.sum(U**2) + np.sum(V**2)))
 
-        return -bound/2
-
-    def grad_uv(self, x):
-        """Return the gradient of U,V,mu_u,mu_v"""
-
-        U, V, mu_u, mu_v = self.recover_matrices(x)
-
-        A = self.D[:,np.newaxis] - self.exp_alpha(U, V, mu_u, mu_v)*self.E_WW_diag()
+        A = self.D[:,np.newaxis] - WW_alpha
         grad_U = -(A @ V - U * 2 * self.lamb)/2
         grad_V = -(A.T @ U - V * 2 * self.lamb)/2
         grad_mu_u = -np.sum(A,axis=1)/2
         grad_mu_v = -np.sum(A,axis=0)/2
 
-        return flatten_matrices(grad_U, grad_V, grad_mu_u, grad_mu_v)
+        return -bound/2, flatten_matrices(grad_U, grad_V, grad_mu_u, grad_mu_v)
+
+    def bound_uv(self, x):
+        """Return the lower bound as function of U,V,mu_u,mu_v
+        ignoring constant terms"""
+        return self.bound_grad_uv(x)[0]
+
+    def grad_uv(self, x):
+        """Return the gradient of U,V,mu_u,mu_v"""
+        return self.bound_grad_uv(x)[1]
 
     def opt_debug(self,x):
         U, V, mu_u, mu_v = self.recover_matrices(x)
@@ -309,33 +1778,73 @@ class GFA:
         print("Ln alpha\n", self.ln_alpha(U,V,mu_u,mu_v))
         print("Bound:\n", self.bound(x))
 
+    def full_rank(self):
+        """Whether the low-rank factorization of log alpha is no constraint"""
+        return self.rank >= min(self.groups, self.factors)
+
     def update_alpha(self):
+        """Update alpha, numerically or in closed form depending on
+        alpha_update"""
+        if self.alpha_update == "closed_form" or \
+                (self.alpha_update == "auto" and self.full_rank()):
+            return self.update_alpha_closed_form()
+        return self.update_alpha_optimize()
+
+    def update_alpha_closed_form(self):
+        """Update alpha to its optimum Dm / diag(E[W(m) W(m).T]), and
+        U, V, mu_u, mu_v to the minimum norm factorization of log alpha"""
+        self.alpha = self.D[:,np.newaxis] / self.E_WW_diag()
+
+        u, s, vt = np.linalg.svd(np.log(self.alpha), full_matrices=False)
+        r = min(len(s), self.rank)
+        self.U = np.zeros((self.groups, self.rank))
+        self.V = np.zeros((self.factors, self.rank))
+        self.U[:,:r] = u[:,:r] * np.sqrt(s[:r])
+        self.V[:,:r] = vt[:r].T * np.sqrt(s[:r])
+        self.mu_u = np.zeros((self.groups, 1))
+        self.mu_v = np.zeros((self.factors, 1))
+        self._invalidate("alpha")
+
+    def update_alpha_optimize(self):
         """Update alpha using joint numerical optimization over
         U, V, mu_u and mu_v
 
+        The optimization starts from the current U, V, mu_u and mu_v; with
+        method BFGS the inverse Hessian estimate of the previous update is
+        reused as well
+
         Output:
         returns an OptimizeResult from scipy for debugging purposes
         """
         x0 = flatten_matrices(self.U, self.V, self.mu_u, self.mu_v)
 
-        if self.opt_iter == "L-BFGS-B":
-            ftol = self.factr * np.finfo(float).eps
-            res = opt.minimize(self.bound_uv, x0, jac=self.grad_uv,
-                               method=self.optimize_method, maxiter=self.opt_iter,
-                               options={"ftol":ftol, "maxiter":self.opt_iter})
-        else:
-            res = opt.minimize(self.bound_uv, x0, jac=self.grad_uv,
-                               method=self.optimize_method,
-                               options={"maxiter":self.opt_iter})
+        method = self.optimize_method.upper()
+        options = {"maxiter":self.opt_iter}
+        if method == "L-BFGS-B":
+            options["ftol"] = self.factr * np.finfo(float).eps
+        elif method == "BFGS" and self.hess_inv is not None \
+                and self.hess_inv.shape == (len(x0), len(x0)):
+            options["hess_inv0"] = self.hess_inv
+
+        res = opt.minimize(self.bound_grad_uv, x0, args=(self.E_WW_diag(),),
+                           jac=True, method=self.optimize_method, options=options)
+        if method == "BFGS":
+            # only keep the estimate if it is still positive definite
+            self.hess_inv = (res.hess_inv + res.hess_inv.T)/2
+            try:
+                np.linalg.cholesky(self.hess_inv)
+            except np.linalg.LinAlgError:
+                self.hess_inv = None
         if not res.success and self.debug:
             raise Exception("optimzation failure")
 
         self.U,self.V,self.mu_u,self.mu_v = self.recover_matrices(res.x)
         self.alpha = self.get_alpha()
+        self._invalidate("alpha")
 
         return res
 
     def update_tau(self):
-        self.b_tau = [self.b_tau_prior + 1/2 * self.E_X_WZ(m)
-                      for m in range(self.groups)]
+        self.b_tau = self.b_tau_prior + 1/2 * self.E_X_WZ_all()
         self.first_update = False
+        self._invalidate("tau")
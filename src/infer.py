@@ -23,11 +23,11 @@ if __name__ == '__main__':
 
     t0 = time.time()
     infer_gfa(X,D,R,K,rep)
-    end1 = t0 - time.time()
+    end1 = time.time() - t0
 
     t0 = time.time()
     infer_fa(X,K)
-    end2 = t0 - time.time()
+    end2 = time.time() - t0
 
     times = np.array([end1, end2])
 
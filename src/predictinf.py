@@ -21,7 +21,6 @@ def run_RMSE(rank, save=True):
             numM = changegroup*groupcounter+groupmin # number of groups
             Dm = 7 # dimension of each group
             D = Dm*np.ones(numM,dtype=int) #groups
-            scalerD=Dm*numM
             N = 30 #samples
             R = 4#min(K,numM)#4 #rank
             if rank == None:
@@ -40,25 +39,8 @@ def run_RMSE(rank, save=True):
                     # Calculate leave-one-prediction
                     print(changegroup)
                     print(trial)
-                    Yminus=np.zeros([N,0]) # K x 0 (matrix will be expanded afterward)
-
-                    T=np.zeros([scalerD-Dm,scalerD-Dm]) # D-Dm x D-Dm
-
-                    Wminus=np.zeros([K,0]) # K x 0 (matrix will be expanded afterward)
-                    Sigma=np.identity(K) # K x K
-                    Wm=g.E_W(Leave) # K x Dm
-
-                    count=0
-                    for i in range(0,numM,1):
-                            if i!=Leave:
-                                    count=count+1
-                                    Yminus=np.c_[Yminus,X.T[:,i*Dm:(i+1)*Dm]]  # N x D-Dm
-                                    T[(count-1)*Dm:count*Dm,(count-1)*Dm:count*Dm]=g.E_tau(i)*np.identity(Dm) # diag({<tau_j>I_Dj}_j\neqm)
-
-                                    Sigma=Sigma+g.E_tau(i)*g.E_WW(i) # I_k+\sum_{j\neqm}<tau_j><W^(j){W^(j)}^{T}>
-                                    Wminus=np.c_[Wminus,g.E_W(i)] # Finally K x D-Dm
-
-                    Xmpre=Yminus @ T @ Wminus.T @ np.linalg.pinv(Sigma) @ Wm  # (N x D-Dm)x(D-Dm x D-Dm)x(D-Dm x K)x(K x K)x(K x Dm)=(K x Dm)
+                    observed=[i for i in range(numM) if i!=Leave]
+                    Xmpre=g.predict(X,observed,[Leave]).T  # N x Dm
 
                     preerr=np.sqrt(np.sum(((X.T[:,Leave*Dm:(Leave+1)*Dm]-Xmpre)/(np.max(X.T[:,Leave*Dm:(Leave+1)*Dm])-np.min(X.T[:,Leave*Dm:(Leave+1)*Dm])))**2))  # squared error of the prediction = scaler
                     print(preerr)
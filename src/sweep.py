@@ -0,0 +1,206 @@
+"""Parallel, resumable runner of the Fig5a/Fig5b experiments
+
+Every cell of the grid (experiment, dataset group, model rank, dataset,
+restart seed) is a single GFA fit, scheduled on a pool of worker processes.
+Each result is appended to a JSON lines store as soon as it finishes,
+together with the GFA options it was fitted with, and the cells already in
+the store with the same options are skipped when the sweep is run again.
+
+  fig5b: fit all samples of the dataset, record the lower bound
+  fig5a: fit the first N_TRAIN samples, predict each group of the next
+         N_TEST samples from the others and record the RMSE variants of
+         Fig5a.py for group 0 and the RMSE of every group
+
+usage: python sweep.py --experiments fig5a fig5b --groups 1 2 \\
+                       --ranks 2 16 2 --num-datasets 20 --jobs 32 --save-npy
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+
+import gfa
+
+GROUPS = ["rank-2", "rank-6", "rank-10"]
+EXPERIMENTS = ["fig5a", "fig5b"]
+Dm = 10
+N_TRAIN = 40
+N_TEST = 10
+
+# datasets loaded by this (worker) process, by path
+_data = {}
+
+def load_datasets(path, group):
+    if path not in _data:
+        with open(path, 'rb') as f:
+            _data[path] = pickle.load(f)
+    return _data[path][GROUPS[group]]
+
+def cell_key(cell, gfa_kwargs):
+    return (cell["experiment"], cell["group"], cell["rank"], cell["dataset"], cell["seed"],
+            json.dumps(gfa_kwargs, sort_keys=True))
+
+def run_cell(cell, data_path, gfa_kwargs):
+    """Fit the model of a single cell of the grid
+
+    Output:
+    the cell with the results added
+    """
+    X = load_datasets(data_path, cell["group"])[cell["dataset"]]
+    D = Dm * np.ones(X.shape[0] // Dm, dtype=int)
+    if cell["experiment"] == "fig5a":
+        X_fit = X[:, :N_TRAIN]
+    else:
+        X_fit = X
+
+    start = time.time()
+    g = gfa.GFA(rank=cell["rank"], random_state=cell["seed"], **gfa_kwargs)
+    g.fit(X_fit, D)
+    result = dict(cell, options=gfa_kwargs, bound=float(g.cost[-1]), n_iter=g.n_iter,
+                  converged=bool(g.converged))
+
+    if cell["experiment"] == "fig5a":
+        X_test = X[:, N_TRAIN:N_TRAIN + N_TEST]
+        X_pred, group_rmse = g.predict_loo(X_test)
+        # the measures of Fig5a.py, for group 0
+        X_unseen = X_test[:Dm].T
+        err = np.sum((X_unseen - X_pred[:Dm].T)**2)
+        span = X_unseen.max() - X_unseen.min()
+        result.update(rmse=float(np.sqrt(err)),
+                      nrmse=float(np.sqrt(err / span)),
+                      nsrmse=float(np.sqrt(err / span**2)),
+                      group_rmse=group_rmse.tolist())
+    result["time"] = time.time() - start
+    return result
+
+def load_results(path):
+    """Read the results in the store at 'path' (a partly written last line,
+    left by a killed run, is ignored)"""
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                pass
+    return results
+
+def make_cells(experiments, groups, ranks, datasets, seeds):
+    return [{"experiment": e, "group": g, "rank": r, "dataset": i, "seed": s}
+            for e, g, r, i, s in itertools.product(experiments, groups, ranks, datasets, seeds)]
+
+def run_sweep(cells, store, data_path="data-fig5.pkl", n_jobs=1, blas_threads=1,
+              **gfa_kwargs):
+    """Run the cells that are not in the store yet with the options
+    gfa_kwargs, appending their results to it as they finish
+
+    Output:
+    the number of cells run
+    """
+    done = {cell_key(result, result.get("options")) for result in load_results(store)}
+    todo = [cell for cell in cells if cell_key(cell, gfa_kwargs) not in done]
+    print("{} of {} cells to run".format(len(todo), len(cells)))
+
+    with open(store, "a") as out:
+        if out.tell() > 0:
+            with open(store, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b"\n":
+                    # end the line left unfinished by a killed run
+                    out.write("\n")
+
+        def save(result):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            print("{experiment} group {group} rank {rank} dataset {dataset} "
+                  "seed {seed}: bound {bound:.6g} ({time:.1f} s)".format(**result))
+
+        if n_jobs == 1:
+            for cell in todo:
+                save(run_cell(cell, data_path, gfa_kwargs))
+            return len(todo)
+
+        with gfa.blas_limited_pool(n_jobs, blas_threads) as pool:
+            futures = [pool.submit(run_cell, cell, data_path, gfa_kwargs)
+                       for cell in todo]
+            for future in concurrent.futures.as_completed(futures):
+                save(future.result())
+    return len(todo)
+
+def best_restarts(results, experiment, group, ranks, datasets):
+    """Pick the restart with the highest bound of every (rank, dataset)
+
+    Output:
+    array of size len(ranks) x len(datasets) of the picked results (None
+    where there is no result)
+    """
+    best = np.full((len(ranks), len(datasets)), None, dtype=object)
+    index = {(r, i): (a, b) for a, r in enumerate(ranks) for b, i in enumerate(datasets)}
+    for result in results:
+        key = (result["rank"], result["dataset"])
+        if result["experiment"] != experiment or result["group"] != group or key not in index:
+            continue
+        a, b = index[key]
+        if best[a, b] is None or result["bound"] > best[a, b]["bound"]:
+            best[a, b] = result
+    return best
+
+def save_npy(results, groups, rstart, rend, rstep, num_datasets):
+    """Save the averages over the datasets in the files written by Fig5a.py
+    and Fig5b.py"""
+    ranks = list(range(rstart, rend + 1, rstep))
+    datasets = range(num_datasets)
+    for group in groups:
+        name = "numdatasets{}-datasetindex{}-modelranks{}-{}-{}".format(
+            num_datasets, group, rstart, rend, rstep)
+        best = best_restarts(results, "fig5b", group, ranks, datasets)
+        if all(best.ravel()):
+            bounds = np.vectorize(lambda r: r["bound"])(best)
+            np.save("Fig5b-" + name, bounds)
+
+        best = best_restarts(results, "fig5a", group, ranks, datasets)
+        if all(best.ravel()):
+            for suffix, field in (("", "rmse"), ("-N", "nrmse"), ("-NS", "nsrmse")):
+                values = np.vectorize(lambda r: r[field])(best)
+                np.save("Fig5a-{}-yaxis{}".format(name, suffix),
+                        values.mean(axis=1, keepdims=True))
+            group_rmse = np.array([[r["group_rmse"] for r in row] for row in best])
+            np.save("Fig5a-{}-yaxis-groups".format(name), group_rmse.mean(axis=1))
+            np.save("Fig5a-{}-xaxis".format(name), np.array(ranks))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the Fig5a/Fig5b grid")
+    parser.add_argument("--experiments", nargs="+", default=EXPERIMENTS, choices=EXPERIMENTS)
+    parser.add_argument("--groups", type=int, nargs="+", default=[1, 2],
+                        help="dataset groups (indices into {})".format(GROUPS))
+    parser.add_argument("--ranks", type=int, nargs=3, default=[2, 16, 2],
+                        metavar=("START", "END", "STEP"))
+    parser.add_argument("--num-datasets", type=int, default=20)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0],
+                        help="restart seeds of every cell")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--data", default="data-fig5.pkl")
+    parser.add_argument("--store", default="sweep-fig5.jsonl")
+    parser.add_argument("--factors", type=int, default=30)
+    parser.add_argument("--max-iter", type=int, default=10000)
+    parser.add_argument("--save-npy", action="store_true",
+                        help="save the averages like Fig5a.py and Fig5b.py")
+    args = parser.parse_args()
+
+    rstart, rend, rstep = args.ranks
+    cells = make_cells(args.experiments, args.groups, range(rstart, rend + 1, rstep),
+                       range(args.num_datasets), args.seeds)
+    gfa_kwargs = dict(factors=args.factors, max_iter=args.max_iter)
+    run_sweep(cells, args.store, data_path=args.data, n_jobs=args.jobs, **gfa_kwargs)
+    if args.save_npy:
+        # only the results of these options, not those of earlier sweeps
+        results = [result for result in load_results(args.store)
+                   if result.get("options") == gfa_kwargs]
+        save_npy(results, args.groups, rstart, rend, rstep, args.num_datasets)